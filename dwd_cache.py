@@ -0,0 +1,271 @@
+import logging
+import os
+import time
+import json
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: index updates are not synchronized between processes
+    fcntl = None
+
+
+class DwdCache:
+    """Size-bounded on-disk cache for DWD downloads.
+
+    Entries are stored as `<cache_directory>/<shard>/<key>`, with the shard taken
+    from a hash of the key. All writes are atomic (temporary file + rename). An
+    index (`index.json`) keeps size, write time and last access time of every
+    entry; entries older than `max_age_secs` are removed, and least recently used
+    entries are evicted until the cache fits into `max_bytes`. The index is shared
+    by all processes using the directory: it is re-read and merged under a file
+    lock (`index.lock`) before it is saved.
+    """
+
+    # Files of the flat cache layout, moved into the shards on first use
+    legacy_prefixes = ("station-list.json", "station-forecast-", "MOSMIX_L_LATEST.kmz")
+
+    def __init__(self, cache_directory, max_bytes=512 * 1024 * 1024, max_age_secs=7 * 24 * 3600):
+        self.log = logging.getLogger("DwdCache")
+        self.cachedir = cache_directory
+        self.max_bytes = max_bytes
+        self.max_age_secs = max_age_secs
+        self.index_file = os.path.join(self.cachedir, "index.json")
+        self.lock_file = os.path.join(self.cachedir, "index.lock")
+        self.index_save_secs = 60  # access times are saved lazily
+        self.lock = threading.Lock()
+        self.removed = set()  # keys removed since the last save
+        with self._index_lock():
+            self.index = self._load_index()
+            self._migrate_legacy()
+            self._write_index()
+        self.index_saved = time.time()
+        self.index_dirty = False
+
+    @contextmanager
+    def _index_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _migrate_legacy(self):
+        for name in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, name)
+            if os.path.isfile(path) is False:
+                continue
+            if name.endswith(".tmp") and name.startswith(self.legacy_prefixes):
+                os.remove(path)  # left over from an interrupted write
+                continue
+            if name.startswith(self.legacy_prefixes) is False:
+                continue
+            if name == "station-forecast-all.json" or name in self.index:
+                os.remove(path)  # never valid / superseded by the sharded entry
+                continue
+            target = self.path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+            st = os.stat(target)
+            self.index[name] = {"size": st.st_size, "mtime": st.st_mtime, "atime": st.st_mtime}
+            self.log.info(f"Migrated {name} into the cache index")
+
+    def _shard(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:2]
+
+    def path(self, key):
+        return os.path.join(self.cachedir, self._shard(key), key)
+
+    def _read_index_file(self):
+        try:
+            with open(self.index_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.log.warning(f"Failed to read cache index {self.index_file}: {e}")
+            return None
+
+    def _load_index(self):
+        index = self._read_index_file()
+        if index is not None:
+            return index
+        index = {}
+        for shard in os.listdir(self.cachedir):
+            shard_dir = os.path.join(self.cachedir, shard)
+            if len(shard) != 2 or os.path.isdir(shard_dir) is False:
+                continue
+            for key in os.listdir(shard_dir):
+                if key.endswith(".tmp"):
+                    os.remove(os.path.join(shard_dir, key))  # left over from an interrupted write
+                    continue
+                st = os.stat(os.path.join(shard_dir, key))
+                index[key] = {"size": st.st_size, "mtime": st.st_mtime, "atime": st.st_mtime}
+        return index
+
+    def _merge_index(self):
+        """Merge entries written or used by other processes into the in-memory index."""
+        disk_index = self._read_index_file() or {}
+        for key, entry in disk_index.items():
+            if key in self.removed:
+                continue
+            mine = self.index.get(key)
+            if mine is None:
+                self.index[key] = entry
+                continue
+            if entry["mtime"] > mine["mtime"]:
+                mine["size"] = entry["size"]
+                mine["mtime"] = entry["mtime"]
+            mine["atime"] = max(mine["atime"], entry["atime"])
+        for key in [k for k in self.index if os.path.exists(self.path(k)) is False]:
+            del self.index[key]  # removed by another process
+
+    def _write_index(self):
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp_file, self.index_file)
+        except Exception as e:
+            self.log.warning(f"Failed to write cache index {self.index_file}: {e}")
+            return False
+        return True
+
+    def _save_index(self, evict=False, keep=None):
+        with self._index_lock():
+            self._merge_index()
+            if evict is True:
+                self._evict(keep=keep)
+            if self._write_index() is False:
+                return
+            self.removed.clear()
+        self.index_saved = time.time()
+        self.index_dirty = False
+
+    def _write(self, key, write_func):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                write_func(f)
+            os.replace(tmp_file, path)
+        except Exception as e:
+            self.log.warning(f"Failed to write cache entry {key}: {e}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+        now = time.time()
+        with self.lock:
+            self.index[key] = {"size": os.path.getsize(path), "mtime": now, "atime": now}
+            self.removed.discard(key)
+            self._save_index(evict=True, keep=key)
+        return True
+
+    def put(self, key, data):
+        """Atomically store bytes under key."""
+        return self._write(key, lambda f: f.write(data))
+
+    def put_stream(self, key, fileobj):
+        """Atomically store the content of a file object (e.g. a download) under key."""
+        return self._write(key, lambda f: shutil.copyfileobj(fileobj, f, 1024 * 1024))
+
+    def put_json(self, key, obj):
+        return self.put(key, json.dumps(obj).encode("utf-8"))
+
+    def get_path(self, key):
+        """Return the file path of an entry and mark it as used, or None if it is not cached."""
+        path = self.path(key)
+        with self.lock:
+            entry = self.index.get(key)
+            if os.path.exists(path) is False:
+                if entry is not None:
+                    del self.index[key]
+                    self.index_dirty = True
+                return None
+            if entry is None:
+                # written by another process since the index was last merged
+                st = os.stat(path)
+                entry = {"size": st.st_size, "mtime": st.st_mtime, "atime": st.st_mtime}
+                self.index[key] = entry
+            entry["atime"] = time.time()
+            self.index_dirty = True
+            if time.time() - self.index_saved > self.index_save_secs:
+                self._save_index()
+        return path
+
+    def get(self, key):
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except Exception as e:
+            self.log.warning(f"Failed to read cache entry {key}: {e}")
+            return None
+
+    def get_json(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def timestamp(self, key):
+        """Write time of an entry, or None."""
+        entry = self.index.get(key)
+        if entry is None:
+            if os.path.exists(self.path(key)) is False:
+                return None
+            return os.path.getmtime(self.path(key))
+        return entry["mtime"]
+
+    def size(self):
+        return sum(entry["size"] for entry in self.index.values())
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+            self._save_index()
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        self.removed.add(key)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep=None):
+        now = time.time()
+        if self.max_age_secs is not None:
+            for key in [k for k, e in self.index.items() if now - e["mtime"] > self.max_age_secs]:
+                self.log.debug(f"Evicting {key}: age > {self.max_age_secs}s")
+                self._remove(key)
+        if self.max_bytes is not None:
+            total = self.size()
+            for key in sorted(self.index, key=lambda k: self.index[k]["atime"]):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                total -= self.index[key]["size"]
+                self.log.debug(f"Evicting {key}: cache size > {self.max_bytes} bytes")
+                self._remove(key)
+
+    def evict(self):
+        with self.lock:
+            self._save_index(evict=True)
+
+    def flush(self):
+        """Save pending access time updates of the index."""
+        with self.lock:
+            if self.index_dirty is True:
+                self._save_index()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""Bulk export of MOSMIX_L all-stations runs to partitioned columnar files.
+
+Each run is written to `<output>/<issue-time>/`, partitioned either by element
+(`element=TTT/part-00000.npz`, values [station, time]) or by region
+(`region=N48E011/part-00000.npz`, one [station, time] array per element).
+Every part also contains the station ids, names, coordinates and the forecast
+times (epoch seconds UTC). Runs with a `_SUCCESS.json` manifest are skipped,
+interrupted runs are resumed from the parts that were finished. Both require
+the layout parameters stored in `_params.json` to match, `force` removes the
+previous export of the run. Without an explicit element list, the elements of
+the first chunk of stations are used for all parts (`run_elements` in
+`_params.json`).
+"""
+
+import logging
+import os
+import sys
+import io
+import json
+import math
+import time
+import shutil
+import zlib
+import zipfile
+import itertools
+import xml.etree.cElementTree as et
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from dwd_forecast import DWD
+
+
+def _filter_tag(tag):
+    i = tag.find("}")
+    if i != -1:
+        return tag[i + 1 :]
+    return tag
+
+
+def _filter_attrib_dict(att):
+    return {_filter_tag(k): v for k, v in att.items()}
+
+
+class _CountingReader(io.RawIOBase):
+    """File wrapper that counts the bytes read, used for throughput reports."""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.f.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.bytes_read += n
+        return n
+
+
+def _open_kml(path):
+    if zipfile.is_zipfile(path):
+        zfile = zipfile.ZipFile(path)
+        return zfile.open(zfile.namelist()[0])
+    return open(path, "rb")
+
+
+def _run_id(issue_time):
+    # '2023-06-22T03:00:00.000Z' -> '20230622T0300Z'
+    return issue_time[:16].replace("-", "").replace(":", "") + "Z"
+
+
+def _region_key(lat, lon, degrees):
+    lat0 = math.floor(lat / degrees) * degrees
+    lon0 = math.floor(lon / degrees) * degrees
+    ns = "N" if lat0 >= 0 else "S"
+    ew = "E" if lon0 >= 0 else "W"
+    return f"{ns}{abs(lat0):g}{ew}{abs(lon0):03g}"
+
+
+def _save_npz(path, **arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _parse_placemark(xml, n_times):
+    node = et.fromstring(xml)
+    station = {"values": {}}
+    for node2 in node.iter():
+        tag = _filter_tag(node2.tag)
+        if tag == "name":
+            station["id"] = node2.text.strip()
+        elif tag == "description":
+            station["name"] = (node2.text or "").strip()
+        elif tag == "coordinates":
+            lon, lat, alt = [float(c) for c in node2.text.split(",")]
+            station["lon"], station["lat"], station["alt"] = lon, lat, alt
+        elif tag == "Forecast":
+            key = _filter_attrib_dict(node2.attrib)["elementName"]
+            for node3 in node2:
+                if _filter_tag(node3.tag) == "value" and node3.text is not None:
+                    tokens = ["nan" if t == "-" else t for t in node3.text.split()]
+                    values = np.array(tokens, dtype=float)
+                    if len(values) == n_times:
+                        station["values"][key] = values
+    return station
+
+
+def _placemark_elements(placemarks):
+    """Sorted element names of a list of Placemark xml strings."""
+    elements = set()
+    for xml in placemarks:
+        for node in et.fromstring(xml).iter():
+            if _filter_tag(node.tag) == "Forecast":
+                elements.add(_filter_attrib_dict(node.attrib)["elementName"])
+    return sorted(elements)
+
+
+def export_chunk(run_dir, chunk_no, placemarks, times, partition, region_degrees, elements, dtype):
+    """Parse a chunk of Placemark xml strings and write its partitions (runs in worker processes).
+
+    `elements` is the element set of the whole run, so that all parts have the same columns.
+    Raises ValueError if values exceed the range of `dtype` (e.g. PPPP in Pa as float16).
+    """
+    stations = [_parse_placemark(xml, len(times)) for xml in placemarks]
+    unknown = sorted(set(k for s in stations for k in s["values"]) - set(elements))
+    if partition == "region":
+        groups = {}
+        for s in stations:
+            groups.setdefault(_region_key(s["lat"], s["lon"], region_degrees), []).append(s)
+    else:
+        groups = {None: stations}
+
+    nan_row = np.full(len(times), np.nan)
+    part = f"part-{chunk_no:05d}.npz"
+    n_bytes = 0
+    for region, group in groups.items():
+        meta = {
+            "station": np.array([s["id"] for s in group]),
+            "name": np.array([s.get("name", "") for s in group]),
+            "lat": np.array([s["lat"] for s in group]),
+            "lon": np.array([s["lon"] for s in group]),
+            "alt": np.array([s["alt"] for s in group]),
+            "time": times,
+        }
+        columns = {}
+        for e in elements:
+            values = np.stack([s["values"].get(e, nan_row) for s in group])
+            with np.errstate(over="ignore"):
+                columns[e] = values.astype(dtype)
+            overflow = np.isfinite(values) & ~np.isfinite(columns[e])
+            if np.any(overflow):
+                raise ValueError(
+                    f"element {e}: values up to {np.nanmax(np.abs(values[overflow]))} "
+                    f"exceed the range of {np.dtype(dtype).name}"
+                )
+        if partition == "region":
+            path = os.path.join(run_dir, f"region={region}", part)
+            n_bytes += _save_npz(path, **meta, **columns)
+        else:
+            for e, values in columns.items():
+                path = os.path.join(run_dir, f"element={e}", part)
+                n_bytes += _save_npz(path, **meta, values=values)
+
+    summary = {
+        "chunk": chunk_no,
+        "stations": len(stations),
+        "elements": len(elements),
+        "unknown_elements": unknown,
+        "bytes": n_bytes,
+    }
+    done_file = os.path.join(run_dir, "_parts", f"part-{chunk_no:05d}.json")
+    os.makedirs(os.path.dirname(done_file), exist_ok=True)
+    with open(f"{done_file}.tmp", "w") as f:
+        json.dump(summary, f)
+    os.replace(f"{done_file}.tmp", done_file)
+    return summary
+
+
+class DwdExport:
+    def __init__(
+        self,
+        output_directory="./export",
+        partition="element",
+        region_degrees=1.0,
+        workers=None,
+        chunk_size=250,
+        elements=None,
+        dtype=np.float32,
+        dwd=None,
+    ):
+        self.log = logging.getLogger("DwdExport")
+        if dwd is None:
+            dwd = DWD()
+        self.dwd = dwd
+        self.output_directory = output_directory
+        self.partition = partition
+        self.region_degrees = region_degrees
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.elements = elements
+        self.dtype = dtype
+
+    def _params(self):
+        """Parameters that determine the output layout, a run is only resumed or skipped if they match."""
+        return {
+            "partition": self.partition,
+            "region_degrees": self.region_degrees if self.partition == "region" else None,
+            "chunk_size": self.chunk_size,
+            "elements": self.elements,
+            "dtype": np.dtype(self.dtype).name,
+        }
+
+    def _placemark_chunks(self, reader, run):
+        """Stream-parse the kml, fill `run` with issue time and time steps, yield lists of Placemark xml."""
+        chunk = []
+        document = None
+        for event, node in et.iterparse(reader, events=("start", "end")):
+            tag = _filter_tag(node.tag)
+            if event == "start":
+                if tag == "Document":
+                    document = node
+                continue
+            if tag == "IssueTime":
+                run["issue_time"] = node.text.strip()
+            elif tag == "TimeStep":
+                run["time_steps"].append(node.text.strip())
+            elif tag == "ForecastTimeSteps":
+                yield None  # product definition complete, run id is known
+            elif tag == "Placemark":
+                chunk.append(et.tostring(node))
+                if document is not None:
+                    document.clear()  # drop parsed placemarks, keeps memory flat
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def export(self, path=None, force=False):
+        """Export one all-stations run (KMZ or KML file, default: latest run from DWD).
+
+        Returns the run directory, or None on failure.
+        """
+        if path is None:
+            path = self.dwd.forecast_all_kmz()
+            if path is None:
+                return None
+        try:
+            return self._export(path, force)
+        except (et.ParseError, zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+            self.log.error(f"{path}: failed to read input: {e}")
+        except ValueError as e:
+            self.log.error(f"{path}: export failed: {e}")
+        return None
+
+    def _add_summary(self, totals, summary):
+        totals["stations"] += summary["stations"]
+        totals["bytes"] += summary["bytes"]
+        if self.elements is None and len(summary.get("unknown_elements", [])) > 0:
+            self.log.warning(
+                f"Part {summary['chunk']}: elements {summary['unknown_elements']} "
+                "are not in the element set of the run, not exported"
+            )
+
+    def _export(self, path, force):
+        reader = _CountingReader(_open_kml(path))
+        run = {"issue_time": None, "time_steps": []}
+        chunks = self._placemark_chunks(io.BufferedReader(reader), run)
+        if next(chunks, None) is not None or run["issue_time"] is None:
+            self.log.error(f"{path}: no MOSMIX product definition found")
+            return None
+        run_dir = os.path.join(self.output_directory, _run_id(run["issue_time"]))
+        manifest_file = os.path.join(run_dir, "_SUCCESS.json")
+        params_file = os.path.join(run_dir, "_params.json")
+        params = self._params()
+        if force is True:
+            if os.path.exists(run_dir):
+                self.log.info(f"Removing previous export {run_dir}")
+                shutil.rmtree(run_dir)
+        elif os.path.exists(run_dir):
+            try:
+                with open(params_file, "r") as f:
+                    previous_params = json.load(f)
+                previous_params.pop("run_elements")
+            except Exception:
+                previous_params = None
+            if previous_params != params:
+                self.log.error(
+                    f"{run_dir} was exported with different parameters "
+                    f"({previous_params}), use --force to re-export"
+                )
+                return None
+            if os.path.exists(manifest_file):
+                self.log.info(f"Run {run['issue_time']} already exported to {run_dir}, skipping")
+                return run_dir
+        os.makedirs(run_dir, exist_ok=True)
+        first_chunk = next(chunks, [])
+        chunks = itertools.chain([first_chunk], chunks)
+        if os.path.exists(params_file) is True:
+            with open(params_file, "r") as f:
+                elements = json.load(f)["run_elements"]
+        else:
+            # Without -e, the elements of the first chunk are used for all parts of the run
+            elements = self.elements
+            if elements is None:
+                elements = _placemark_elements(first_chunk)
+            with open(f"{params_file}.tmp", "w") as f:
+                json.dump({**params, "run_elements": elements}, f, indent=2)
+            os.replace(f"{params_file}.tmp", params_file)
+        times = (
+            np.array([t.rstrip("Z") for t in run["time_steps"]], dtype="datetime64[s]")
+            .astype(np.int64)
+        )
+        self.log.info(f"Exporting run {run['issue_time']} ({len(times)} time steps) to {run_dir}")
+
+        start = time.time()
+        n_chunks = 0
+        n_skipped = 0
+        totals = {"stations": 0, "bytes": 0}  # exported by this call
+        resumed = {"stations": 0, "bytes": 0}  # parts of an interrupted earlier export
+        pending = set()
+        max_pending = 2 * (self.workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for chunk in chunks:
+                chunk_no = n_chunks
+                n_chunks += 1
+                done_file = os.path.join(run_dir, "_parts", f"part-{chunk_no:05d}.json")
+                if os.path.exists(done_file):
+                    n_skipped += 1
+                    with open(done_file, "r") as f:
+                        self._add_summary(resumed, json.load(f))
+                    continue
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._add_summary(totals, future.result())
+                    self._report(start, totals["stations"], totals["bytes"], reader.bytes_read)
+                pending.add(
+                    pool.submit(
+                        export_chunk,
+                        run_dir,
+                        chunk_no,
+                        chunk,
+                        times,
+                        self.partition,
+                        self.region_degrees,
+                        elements,
+                        self.dtype,
+                    )
+                )
+            for future in pending:
+                self._add_summary(totals, future.result())
+
+        secs = time.time() - start
+        self._report(start, totals["stations"], totals["bytes"], reader.bytes_read)
+        manifest = {
+            "issue_time": run["issue_time"],
+            "source": path,
+            "params": params,
+            "elements": elements,
+            "time_steps": len(times),
+            "chunks": n_chunks,
+            "chunks_resumed": n_skipped,
+            "stations_exported": totals["stations"] + resumed["stations"],
+            "stations_resumed": resumed["stations"],
+            "bytes_written": totals["bytes"] + resumed["bytes"],
+            "seconds": secs,
+        }
+        with open(f"{manifest_file}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{manifest_file}.tmp", manifest_file)
+        self.log.info(
+            f"Run {run['issue_time']} done: {n_chunks} chunks ({n_skipped} resumed), "
+            f"{totals['stations']} stations in {secs:.1f}s"
+        )
+        return run_dir
+
+    def _report(self, start, n_stations, n_bytes, bytes_read):
+        secs = max(time.time() - start, 1e-6)
+        self.log.info(
+            f"{n_stations} stations, {n_stations / secs:.0f} stations/s, "
+            f"xml in: {bytes_read / secs / 1e6:.1f} MB/s, out: {n_bytes / secs / 1e6:.1f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Export MOSMIX_L all-stations runs to partitioned .npz files"
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="KMZ/KML files of all-stations runs, default: download the latest run",
+    )
+    parser.add_argument("-o", "--output", default="./export", help="output directory")
+    parser.add_argument(
+        "-p",
+        "--partition",
+        choices=["element", "region"],
+        default="element",
+        help="partition files by element or by region",
+    )
+    parser.add_argument(
+        "--region-degrees",
+        type=float,
+        default=1.0,
+        help="size of the lat/lon region grid in degrees",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, help="number of worker processes (default: cpu count)"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=250, help="placemarks (stations) per part"
+    )
+    parser.add_argument("-e", "--elements", help="comma separated elements (default: all)")
+    parser.add_argument(
+        "--dtype",
+        choices=["f32", "f16"],
+        default="f32",
+        help="value type of the output, f16 fails for values beyond +-65504 "
+        "(DWD units, e.g. PPPP in Pa)",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        default=False,
+        action="store_true",
+        help="remove and re-export runs that were already (partially) exported",
+    )
+    parser.add_argument("-v", "--verbose", default=False, action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+    )
+    exporter = DwdExport(
+        output_directory=args.output,
+        partition=args.partition,
+        region_degrees=args.region_degrees,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        elements=args.elements.split(",") if args.elements else None,
+        dtype=np.float16 if args.dtype == "f16" else np.float32,
+    )
+    inputs = args.inputs if len(args.inputs) > 0 else [None]
+    failed = 0
+    for path in inputs:
+        if exporter.export(path, force=args.force) is None:
+            failed += 1
+    sys.exit(1 if failed > 0 else 0)
@@ -2,7 +2,8 @@ import logging
 import os
 import time
 import json
-import pandas as pd
+import pickle
+import threading
 import xml.etree.cElementTree as et
 import zipfile
 import datetime
@@ -15,18 +16,28 @@ except ImportError:
 from io import StringIO, BytesIO
 from zipfile import ZipFile
 
-try:
-    from geopy import distance
-    geopy_loaded=True
-except:
-    geopy_loaded=False
-    logging.warning('location search not available: geopy not installed.')
+from dwd_cache import DwdCache
+
+# pandas (and optionally geopy) are imported on first use to keep startup fast.
+
+def _geopy_distance():
+    try:
+        from geopy import distance
+    except ImportError:
+        return None
+    return distance
+
+def _haversine_km(lat, lon, lats, lons):
+    import numpy as np
+    lat, lon, lats, lons = map(np.radians, (lat, lon, np.asarray(lats), np.asarray(lons)))
+    a = np.sin((lats-lat)/2)**2 + np.cos(lat)*np.cos(lats)*np.sin((lons-lon)/2)**2
+    return 2 * 6371.0088 * np.arcsin(np.sqrt(a))
 
 # Doc on fields:
 # https://opendata.dwd.de/weather/lib/MetElementDefinition.xml
 
 class DWD:
-    def __init__(self, cache_directory=None):
+    def __init__(self, cache_directory=None, cache_max_bytes=512*1024*1024, cache_max_age_secs=7*24*3600):
         self.log = logging.getLogger("DWD")
         if cache_directory is None:
             self.cachedir=self._get_default_cachedir()
@@ -43,12 +54,25 @@ class DWD:
                     self.init=False
                     return
             self.cachedir=cache_directory
+        self.cache=DwdCache(self.cachedir, max_bytes=cache_max_bytes, max_age_secs=cache_max_age_secs)
         self.station_list_url='https://www.dwd.de/DE/leistungen/klimadatendeutschland/statliste/statlex_html.html?view=nasPublication&nn=16102'
         self.station_list_cache_days=1
         self.station_list_df=None
+        self.station_list_timestamp=None
+        self.station_index_cache=None
         self.forecasts_all_url='https://opendata.dwd.de/weather/local_forecasts/mos/MOSMIX_L/all_stations/kml/MOSMIX_L_LATEST.kmz'
         self.forecast_station_url='https://opendata.dwd.de/weather/local_forecasts/mos/MOSMIX_L/single_stations/{0}/kml/MOSMIX_L_LATEST_{0}.kmz'
         self.forecast_max_cache_secs=3600
+        self.forecasts={}  # station key -> (timestamp of forecast run, forecast)
+        self.snapshot_file=os.path.join(self.cachedir, 'snapshot.pickle')
+        self.snapshot_autosave=False
+        self.snapshot_save_secs=60  # autosave at most once per minute
+        self.snapshot_lock=threading.Lock()  # snapshot flags and state copies, never held during I/O
+        self.snapshot_io_lock=threading.Lock()  # serializes reading and writing the snapshot file
+        self.snapshot_loading=False
+        self.snapshot_dirty=False
+        self.snapshot_saved=0
+        self.snapshot_timer=None
 
     def _get_default_cachedir(self):
         cachedir= "./cache"
@@ -73,51 +97,70 @@ class DWD:
             d[self._filter_tag(el)] = att[el]
         return d
 
-    def _is_uptodate(self, i):
+    def station_index(self):
+        ''' return dict of numpy arrays (row, id, name, lat, lon) of up-to-date stations '''
+        import numpy as np
+        import pandas as pd
         if self.station_list_df is None:
-            return False
-        tim=self.station_list_df['EndeDT'][i]
-        if pd.isna(tim) is False:
-            delta=datetime.datetime.now()-self.station_list_df['EndeDT'][i]
-            if delta.total_seconds() < 7 * 24 * 3600: # Max 7 days
-                return True
-        return False
+            self.read_station_list()
+        if self.station_list_df is None:
+            return None
+        if self.station_index_cache is not None:
+            return self.station_index_cache
+        df=self.station_list_df
+        ende=pd.to_datetime(df['EndeDT'], errors='coerce')
+        age=(datetime.datetime.now()-ende).dt.total_seconds().to_numpy()
+        rows=np.flatnonzero(age < 7 * 24 * 3600) # Max 7 days, NaT compares False
+        self.station_index_cache={
+            'row': rows,
+            'id': df['Stations-kennung'].to_numpy()[rows],
+            'name': df['Stationsname'].to_numpy()[rows],
+            'lat': df['Breite'].to_numpy(dtype=float)[rows],
+            'lon': df['Länge'].to_numpy(dtype=float)[rows],
+        }
+        return self.station_index_cache
 
     def get_closest(self, lat, lon):
-        ''' return tuple of (station-id, name, distance (km)) '''
-        if geopy_loaded is False:
-            self.log.error("get_closest() requires geopy module.")
+        ''' return tuple of (station-id, name, distance (km)), distance is a geopy Distance if geopy is installed '''
+        import numpy as np
+        index=self.station_index()
+        if index is None:
+            self.log.error("Failed to get station-list")
             return None
-        if self.station_list_df is None:
-            self.read_station_list()
-        dists=[]
-        for i in range(len(self.station_list_df)):
-            if self._is_uptodate(i):
-                lati=self.station_list_df['Breite'][i]
-                loni=self.station_list_df['Länge'][i]
-                dist=distance.distance((lat, lon), (lati, loni))
-                dists.append((i,dist))
-        sdists=sorted(dists,key=lambda x: x[1])
-        for di in sdists[:100]:
-            url=self.forecast_station_url.format(self.station_list_df['Stations-kennung'][di[0]])
+        distance=_geopy_distance()
+        dists=_haversine_km(lat, lon, index['lat'], index['lon'])
+        for i in np.argsort(dists, kind='stable')[:100]:
+            url=self.forecast_station_url.format(index['id'][i])
             try:
                 urlopen(url)
-                return (self.station_list_df['Stations-kennung'][di[0]], self.station_list_df['Stationsname'][di[0]], di[1])
             except:
-                logging.debug(f"Station {self.station_list_df['Stations-kennung'][di[0]]} fails")
+                logging.debug(f"Station {index['id'][i]} fails")
+                continue
+            if distance is not None:
+                dist=distance.distance((lat, lon), (index['lat'][i], index['lon'][i]))
+            else:
+                dist=float(dists[i])
+            return (index['id'][i], index['name'][i], dist)
         return None
 
     def read_station_list(self, force_cache_refresh=False):
+        import pandas as pd
+        if force_cache_refresh is False and self.station_list_df is not None and self.station_list_timestamp is not None:
+            if time.time() - self.station_list_timestamp <= self.station_list_cache_days *24*3600:
+                return self.station_list_df
         df=None
-        station_cache_file = os.path.join(self.cachedir, 'station-list.json')
+        station_list_timestamp=None
+        station_cache_key = 'station-list.json'
         read_station_list=False
-        if force_cache_refresh is True or os.path.exists(station_cache_file) is False:
+        if force_cache_refresh is True:
             read_station_list=True
         else:
             try:
-                with open(station_cache_file, 'r') as f:
-                    station_list=json.load(f)
-                    self.log.debug(f'Read station list {station_cache_file} from cache')
+                station_list=self.cache.get_json(station_cache_key)
+                if station_list is None:
+                    raise FileNotFoundError(f'{station_cache_key} not cached')
+                self.log.debug(f'Read station list {station_cache_key} from cache')
+                station_list_timestamp=station_list['timestamp']
                 if time.time() - station_list['timestamp'] > self.station_list_cache_days *24*3600:
                     self.log.info(f'Refreshing station list, age is > {self.station_list_cache_days}')
                     read_station_list=True
@@ -138,7 +181,7 @@ class DWD:
                     self.log.warning(f'Failed to convert station list to dataframe: {e}, trying to reload')
                     read_station_list=True
             except Exception as e:
-                self.log.error(f'Failed to read station-list {station_cache_file}: {e}')
+                self.log.info(f'Failed to read station-list {station_cache_key}: {e}')
                 read_station_list=True
 
         if read_station_list is True:
@@ -166,14 +209,16 @@ class DWD:
             except Exception as e:
                 self.log.error(f'Failed to convert dataframe to json: {e}')
                 return None
-            station_list['timestamp']=time.time()
-            try:
-                with open(station_cache_file, 'w') as f:
-                    json.dump(station_list,f)
-            except Exception as e:
-                self.log.warning(f'Failed to save station_list cache {station_cache_file}: {e}')
+            station_list_timestamp=time.time()
+            station_list['timestamp']=station_list_timestamp
+            if self.cache.put_json(station_cache_key, station_list) is False:
+                self.log.warning(f'Failed to save station_list cache {station_cache_key}')
 
         self.station_list_df=df
+        self.station_list_timestamp=station_list_timestamp
+        self.station_index_cache=None
+        if read_station_list is True:
+            self._autosave_snapshot()
         return df
 
     def search_station_by_name(self, name):
@@ -214,51 +259,105 @@ class DWD:
             return None
         return iodata
 
-    def _download_forecast_all(self):
-        return self._download_unpack(self.forecasts_all_url)
+    def _unpack(self, kmz_file):
+        try:
+            with ZipFile(kmz_file) as zfile:
+                iodata = zfile.open(
+                    zfile.namelist()[0]).read()
+        except Exception as e:
+            self.log.error(f'Unable to unpack {kmz_file}: {e}')
+            return None
+        return iodata
+
+    def forecast_all_kmz(self, force_cache_refresh=False):
+        ''' return path of the cached all-stations KMZ file, downloaded (streamed) if older than forecast_max_cache_secs '''
+        kmz_key = 'MOSMIX_L_LATEST.kmz'
+        kmz_file = self.cache.get_path(kmz_key)
+        if force_cache_refresh is False and kmz_file is not None:
+            if time.time() - self.cache.timestamp(kmz_key) <= self.forecast_max_cache_secs:
+                return kmz_file
+        try:
+            self.log.debug(f'Downloading: {self.forecasts_all_url}')
+            with urlopen(self.forecasts_all_url) as resp:
+                if self.cache.put_stream(kmz_key, resp) is False:
+                    return None
+        except Exception as e:
+            self.log.error(f'Unable to download {self.forecasts_all_url}: {e}')
+            return None
+        return self.cache.get_path(kmz_key)
 
     def _download_station_forecast_raw(self,  station_id):
         dl_url = self.forecast_station_url.format(station_id)
         return self._download_unpack(dl_url)
 
-    def station_forecast(self, station_id, force_cache_refresh=False):
+    def _forecast_key(self, station_id):
         if station_id is None:
-            forecast_cache_file = os.path.join(self.cachedir, 'station-forecast-all.json')
-        else:
-            forecast_cache_file = os.path.join(self.cachedir, f'station-forecast-{station_id}.json')
+            return 'all'
+        return str(station_id)
+
+    def forecast_run(self, station_id):
+        ''' return timestamp of the forecast run currently held for station_id, or None '''
+        entry=self.forecasts.get(self._forecast_key(station_id))
+        if entry is None:
+            return None
+        return entry[0]
+
+    def station_forecasts(self, station_ids, force_cache_refresh=False, max_workers=8):
+        ''' return dict station_id -> forecast (or None) for several stations, downloads run in parallel '''
+        from concurrent.futures import ThreadPoolExecutor
+        def load(station_id):
+            return self.station_forecast(station_id, force_cache_refresh=force_cache_refresh)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            forecasts=dict(zip(station_ids, pool.map(load, station_ids)))
+        return forecasts
+
+    def station_forecast(self, station_id, force_cache_refresh=False):
+        import pandas as pd
+        forecast_key=self._forecast_key(station_id)
+        if force_cache_refresh is False and forecast_key in self.forecasts:
+            forecast_timestamp, forecast=self.forecasts[forecast_key]
+            if time.time() - forecast_timestamp <= self.forecast_max_cache_secs:
+                return forecast
+
+        forecast_cache_key = f'station-forecast-{station_id}.json'
 
         dfd=None
         locations=None
+        forecast_timestamp=None
         read_station_forecast=False
-        if force_cache_refresh is True or os.path.exists(forecast_cache_file) is False:
+        if force_cache_refresh is True or station_id is None:
+            # the all-stations run is cached as downloaded KMZ (see forecast_all_kmz())
             read_station_forecast=True
         else:
             try:
-                with open(forecast_cache_file, 'r') as f:
-                    station_forecast=json.load(f)
+                station_forecast=self.cache.get_json(forecast_cache_key)
+                if station_forecast is None:
+                    raise FileNotFoundError(f'{forecast_cache_key} not cached')
+                forecast_timestamp=station_forecast['timestamp']
                 if time.time() - station_forecast['timestamp'] > self.forecast_max_cache_secs:
                     self.log.info(f'Refreshing station forecast, age is > {self.forecast_max_cache_secs}')
                     read_station_forecast=True
                 del station_forecast['timestamp']
                 try:
-                    if station_id is None:
-                        locations=pd.read_json(json.dumps(station_forecast))
-                        self.log.debug(f'Station forecast ALL read from cache {forecast_cache_file}')
-                    else:
-                        dfd=pd.read_json(json.dumps(station_forecast))
-                        self.log.debug(f'Station forecast {station_id} read from cache {forecast_cache_file}')
+                    dfd=pd.read_json(json.dumps(station_forecast))
+                    self.log.debug(f'Station forecast {station_id} read from cache {forecast_cache_key}')
                 except Exception as e:
                     self.log.warning(f'Failed to convert station forecast to dataframe: {e}, trying to reload')
                     read_station_forecast=True
             except Exception as e:
-                self.log.error(f'Failed to read station forecast {forecast_cache_file}: {e}')
+                self.log.info(f'Failed to read station forecast {forecast_cache_key}: {e}')
                 read_station_forecast =True
 
         if read_station_forecast is True:
             if station_id is None:
-                iodata = self._download_forecast_all()
+                kmz_file = self.forecast_all_kmz(force_cache_refresh=force_cache_refresh)
+                if kmz_file is None:
+                    return None
+                iodata = self._unpack(kmz_file)
+                forecast_timestamp=os.path.getmtime(kmz_file)
             else:
                 iodata = self._download_station_forecast_raw(station_id)
+                forecast_timestamp=time.time()
             if iodata is None:
                 return None
             self.log.debug(f"Starting to parse station {station_id} xml...")
@@ -281,9 +380,16 @@ class DWD:
                     for node3 in node2:
                         tag = self._filter_tag(node3.tag)
                         att = self._filter_attrib_dict(node3.attrib)
+                        if location is not None and tag == 'name':
+                            location['id'] = node3.text
+                        if location is not None and tag == 'description':
+                            location['name'] = node3.text
                         for node4 in node3:
                             tag = self._filter_tag(node4.tag)
                             att = self._filter_attrib_dict(node4.attrib)
+                            if location is not None and tag == 'coordinates':
+                                lon, lat, alt = [float(c) for c in node4.text.split(',')]
+                                location['lat'], location['lon'], location['alt'] = lat, lon, alt
                             if tag == 'Forecast':
                                 key = att['elementName']
                             for node5 in node4:
@@ -301,47 +407,135 @@ class DWD:
                                         pd.Series(data, index=dfd.index), errors='coerce')
                                 else:
                                     data = None
-                if location is not None:
-                    dfd.index=dfd.index.tz_convert(tz=None)
-                    location['forecast'] = dfd
-                    locations.append(location)
-                    location = None
+                    if location is not None:
+                        # one entry per Placemark (the all-stations run has thousands)
+                        dfd.index=dfd.index.tz_convert(tz=None)
+                        location['forecast'] = dfd
+                        locations.append(location)
+                        location = None
             if station_id is not None:
                 if len(locations)!=1:
-                    self.log.error('Internal: length of locations is {len(locations)}, expected 1.')
+                    self.log.error(f'Internal: length of locations is {len(locations)}, expected 1.')
                     return False
                 dfd=locations[0]['forecast']
+                self.forecasts[forecast_key]=(forecast_timestamp, dfd)
                 try:
                     forecast=json.loads(dfd.to_json())
-                    forecast['timestamp']=time.time()
+                    forecast['timestamp']=forecast_timestamp
                 except Exception as e:
                     self.log.warning(f'Failed to convert forecast to json: {e}')
                     return dfd
-                try:
-                    with open(forecast_cache_file, 'w') as f:
-                        json.dump(forecast,f)
-                except Exception as e:
-                    self.log.warning(f'Failed to write forecast cache file {forecast_cache_file}: {e}')
+                if self.cache.put_json(forecast_cache_key, forecast) is False:
+                    self.log.warning(f'Failed to write forecast cache {forecast_cache_key}')
             else:
-                try:
-                    all_forecasts={'timestamp': time.time(),
-                                    locations: []}
-                    forecasts=json.loads(locations.to_json())
-                    forecast['timestamp']=time.time()
-                except Exception as e:
-                    self.log.warning(f'Failed to convert forecast to json: {e}')
-                    return dfd
-                try:
-                    with open(forecast_cache_file, 'w') as f:
-                        json.dump(forecast,f)
-                except Exception as e:
-                    self.log.warning(f'Failed to write forecast cache file {forecast_cache_file}: {e}')
-                
+                self.forecasts[forecast_key]=(forecast_timestamp, locations)
+        else:
+            self.forecasts[forecast_key]=(forecast_timestamp, dfd)
+
+        if read_station_forecast is True and station_id is not None:
+            self._autosave_snapshot()
         if station_id is None:
             return locations
         else:
             return dfd
 
+    def save_snapshot(self, snapshot_file=None):
+        ''' save station list, station index and single station forecasts for a fast restart, see load_snapshot() '''
+        if snapshot_file is None:
+            snapshot_file=self.snapshot_file
+        with self.snapshot_lock:
+            snapshot={
+                'version': 1,
+                'timestamp': time.time(),
+                'station_list': (self.station_list_timestamp, self.station_list_df),
+                'station_index': self.station_index_cache,
+                # all-stations forecasts are too large for a fast restart
+                'forecasts': {key: entry for key, entry in list(self.forecasts.items()) if key!='all'},
+            }
+        with self.snapshot_io_lock:
+            tmp_file=f'{snapshot_file}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, snapshot_file)
+            except Exception as e:
+                self.log.warning(f'Failed to write snapshot {snapshot_file}: {e}')
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                return False
+            self.snapshot_saved=time.time()
+        self.log.debug(f'Snapshot saved to {snapshot_file}')
+        return True
+
+    def _autosave_snapshot(self):
+        # Saves run in a background timer, at most every snapshot_save_secs, and not
+        # before load_snapshot() has finished (it would overwrite the snapshot with partial state).
+        if self.snapshot_autosave is False:
+            return
+        with self.snapshot_lock:
+            self.snapshot_dirty=True
+            if self.snapshot_timer is not None or self.snapshot_loading is True:
+                return
+            delay=max(0, self.snapshot_save_secs - (time.time() - self.snapshot_saved))
+            self.snapshot_timer=threading.Timer(delay, self._autosave_worker)
+            self.snapshot_timer.daemon=True
+            self.snapshot_timer.start()
+
+    def _autosave_worker(self):
+        with self.snapshot_lock:
+            self.snapshot_timer=None
+            if self.snapshot_dirty is False:
+                return
+            self.snapshot_dirty=False
+        self.save_snapshot()
+
+    def load_snapshot(self, snapshot_file=None, background=False):
+        ''' restore station list, station index and forecasts saved by save_snapshot().
+        Entries that are already loaded are kept, outdated forecasts are refreshed on next access.
+        With background=True, the snapshot is loaded in a thread which is returned. '''
+        if background is True:
+            self.snapshot_loading=True
+            thread=threading.Thread(target=self.load_snapshot, args=(snapshot_file,))
+            thread.daemon=True
+            thread.start()
+            return thread
+        if snapshot_file is None:
+            snapshot_file=self.snapshot_file
+        self.snapshot_loading=True
+        try:
+            return self._load_snapshot(snapshot_file)
+        finally:
+            with self.snapshot_lock:
+                self.snapshot_loading=False
+                dirty=self.snapshot_dirty
+            if dirty is True:
+                self._autosave_snapshot()
+
+    def _load_snapshot(self, snapshot_file):
+        if os.path.exists(snapshot_file) is False:
+            return False
+        try:
+            with self.snapshot_io_lock:
+                with open(snapshot_file, 'rb') as f:
+                    snapshot=pickle.load(f)
+        except Exception as e:
+            self.log.warning(f'Failed to read snapshot {snapshot_file}: {e}')
+            return False
+        if snapshot.get('version')!=1:
+            self.log.warning(f'Ignoring snapshot {snapshot_file} with unknown version')
+            return False
+        station_list_timestamp, station_list_df=snapshot['station_list']
+        with self.snapshot_lock:
+            if self.station_list_df is None and station_list_df is not None:
+                self.station_list_df=station_list_df
+                self.station_list_timestamp=station_list_timestamp
+                self.station_index_cache=snapshot['station_index']
+            for key, entry in snapshot['forecasts'].items():
+                if key not in self.forecasts:
+                    self.forecasts[key]=entry
+        self.log.info(f"Snapshot {snapshot_file} loaded, {len(snapshot['forecasts'])} forecasts")
+        return True
+
 
 if __name__ == '__main__':
     logging.basicConfig(
@@ -0,0 +1,178 @@
+import logging
+import threading
+
+import numpy as np
+
+from dwd_forecast import DWD
+
+# Doc on fields and their units:
+# https://opendata.dwd.de/weather/lib/MetElementDefinition.xml
+
+KELVIN_ELEMENTS = ["TTT", "Td", "TX", "TN", "TM", "TG", "T5cm"]  # K -> °C
+SECONDS_ELEMENTS = ["SunD", "SunD1", "SunD3", "DRR1"]  # s -> h
+# Probabilities, % -> 0..1: significant weather (fog, precipitation, drizzle, ... per
+# 1 h, 6 h, 12 h and 24 h), precipitation amount thresholds, gusts, sunshine and visibility.
+PERCENT_ELEMENTS = (
+    [f"ww{c}{period}" for c in "MPZDCTLSF" for period in ["", "6", "h", "d"]]
+    + ["R101", "R102", "R103", "R105", "R107", "R110", "R120", "R130", "R150"]
+    + ["RR1o1", "RR1w1", "RR1u1", "R600", "R602", "R610", "R650"]
+    + ["Rh00", "Rh02", "Rh10", "Rh50", "Rd00", "Rd02", "Rd10", "Rd50"]
+    + ["FX625", "FX640", "FX655", "FXh25", "FXh40", "FXh55"]
+    + ["PSd00", "PSd30", "PSd60", "VV10"]
+)
+PASCAL_ELEMENTS = ["PPPP"]  # Pa -> hPa
+# All other elements keep DWD units, e.g. cloud cover N, Neff (%), relative sunshine
+# RSunD (%), wind FF, FX1 (m/s), visibility VV (m), precipitation RR1c (kg/m2).
+
+UNIT_CONVERSIONS = [  # (elements, scale, offset): display = raw * scale + offset
+    (KELVIN_ELEMENTS, 1.0, -273.15),
+    (SECONDS_ELEMENTS, 1 / 3600.0, 0.0),
+    (PERCENT_ELEMENTS, 1 / 100.0, 0.0),
+    (PASCAL_ELEMENTS, 1 / 100.0, 0.0),
+]
+
+
+def convert_units(dfd):
+    """Return a copy of a DWD forecast frame in display units, the input is not modified."""
+    dxl = dfd.copy()
+    for elements, scale, offset in UNIT_CONVERSIONS:
+        cols = [c for c in elements if c in dxl.columns]
+        if len(cols) > 0:
+            dxl[cols] = dxl[cols].to_numpy() * scale + offset
+    return dxl
+
+
+def add_derived(dxl):
+    """Add derived fields to a frame in display units (see convert_units), in place.
+
+    `dew_spread`: temperature minus dew point (°C),
+    `wind_chill`: wind chill temperature (°C, Environment Canada formula), equal to
+    the temperature outside of its domain (T > 10°C or wind <= 4.8 km/h).
+    """
+    if "TTT" in dxl.columns and "Td" in dxl.columns:
+        dxl["dew_spread"] = dxl["TTT"].to_numpy() - dxl["Td"].to_numpy()
+    if "TTT" in dxl.columns and "FF" in dxl.columns:
+        t = dxl["TTT"].to_numpy()
+        v = dxl["FF"].to_numpy() * 3.6  # m/s -> km/h
+        with np.errstate(invalid="ignore"):
+            v16 = np.power(v, 0.16)
+            wc = 13.12 + 0.6215 * t - 11.37 * v16 + 0.3965 * t * v16
+            dxl["wind_chill"] = np.where((t <= 10.0) & (v > 4.8), wc, t)
+    return dxl
+
+
+def daily_aggregates(dxl, tz=None):
+    """Daily min/max of temperatures and sums of sunshine, rain duration and precipitation.
+
+    Days are UTC days, unless a timezone name (e.g. 'Europe/Berlin') is given as `tz`.
+    """
+    agg = {}
+    for col in ["TTT", "wind_chill"]:
+        if col in dxl.columns:
+            agg[f"{col}_min"] = (col, "min")
+            agg[f"{col}_max"] = (col, "max")
+    for col in ["SunD1", "DRR1", "RR1c"]:
+        if col in dxl.columns:
+            agg[f"{col}_sum"] = (col, "sum")
+    frame = dxl[sorted(set(a[0] for a in agg.values()))]
+    if tz is not None:
+        frame = frame.tz_localize("UTC").tz_convert(tz)
+    return frame.resample("D").agg(**agg)
+
+
+def local_extrema(y, mindist=2):
+    """Indices of local minima and maxima of `y`.
+
+    Plateaus are attributed to their last sample. Extrema closer than `mindist`
+    samples to the previously accepted extremum are dropped, so minima and maxima
+    alternate. Returns (mins, maxs) as numpy index arrays.
+    """
+    y = np.asarray(y, dtype=float)
+    if len(y) < 3:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    d = np.sign(np.nan_to_num(np.diff(y)))
+    # forward-fill flat steps with the last non-zero direction
+    nz = np.where(d != 0, np.arange(len(d)), 0)
+    d = d[np.maximum.accumulate(nz)]
+    turn = np.flatnonzero(d[:-1] != d[1:]) + 1
+    turn = turn[d[turn - 1] != 0]  # leading flat section is no extremum
+    is_max = d[turn - 1] > 0
+    # debounce: only the (few) turning points are walked, not the series
+    keep = []
+    last = None
+    for i, idx in enumerate(turn):
+        if last is not None and (idx - turn[last] < mindist or is_max[i] == is_max[last]):
+            continue
+        keep.append(i)
+        last = i
+    keep = np.asarray(keep, dtype=int)
+    turn = turn[keep]
+    is_max = is_max[keep]
+    return turn[~is_max], turn[is_max]
+
+
+class DwdForecastTransform:
+    """Derived quantities for DWD forecasts, memoized per forecast run.
+
+    Raw frames returned by DWD.station_forecast() are never modified.
+    """
+
+    def __init__(self, dwd=None, mindist=5):
+        self.log = logging.getLogger("DwdForecastTransform")
+        if dwd is None:
+            dwd = DWD()
+        self.dwd = dwd
+        self.mindist = mindist
+        self.memo = {}  # station key -> derived forecast dict
+        self.lock = threading.Lock()
+
+    def compute(self, dfd, station_id=None, run=None):
+        """Compute all derived data of a raw DWD forecast frame."""
+        dxl = add_derived(convert_units(dfd))
+        if "TTT" in dxl.columns:
+            mins, maxs = local_extrema(dxl["TTT"].to_numpy(), mindist=self.mindist)
+        else:
+            mins, maxs = np.array([], dtype=int), np.array([], dtype=int)
+        return {
+            "station_id": station_id,
+            "run": run,
+            "raw": dfd,
+            "frame": dxl,
+            "daily": daily_aggregates(dxl),
+            "mins": mins,
+            "maxs": maxs,
+        }
+
+    def station_forecast(self, station_id, force_cache_refresh=False):
+        """Return the derived forecast dict of a station, or None if no forecast is available.
+
+        Keys: `raw` (DWD frame), `frame` (display units and derived fields), `daily`
+        (daily aggregates), `mins`, `maxs` (indices of local temperature extrema into `frame`),
+        `run` (timestamp of the forecast run).
+        """
+        dfd = self.dwd.station_forecast(station_id, force_cache_refresh=force_cache_refresh)
+        return self._derived(station_id, dfd)
+
+    def _derived(self, station_id, dfd):
+        # memoized derived forecast of a raw frame returned by the DWD instance
+        if dfd is None or dfd is False:
+            return None
+        run = self.dwd.forecast_run(station_id)
+        key = str(station_id)
+        with self.lock:
+            entry = self.memo.get(key)
+            if entry is not None and entry["run"] == run and entry["raw"] is dfd:
+                return entry
+        self.log.debug(f"Computing derived forecast for {station_id}, run {run}")
+        entry = self.compute(dfd, station_id=station_id, run=run)
+        with self.lock:
+            self.memo[key] = entry
+        return entry
+
+    def station_forecasts(self, station_ids, force_cache_refresh=False):
+        """Derived forecasts of several stations (list, None for unavailable stations).
+
+        Missing forecasts are loaded as one batch, see DWD.station_forecasts().
+        """
+        forecasts = self.dwd.station_forecasts(station_ids, force_cache_refresh=force_cache_refresh)
+        return [self._derived(id, forecasts[id]) for id in station_ids]
@@ -3,25 +3,33 @@
 
 import logging
 
-import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 
 import datetime
-from matplotlib.dates import MO, TU, WE, TH, FR, SA, SU
-from matplotlib.dates import WeekdayLocator
-from matplotlib.dates import DateFormatter
-from matplotlib.ticker import MaxNLocator
 
 from dateutil import tz
 import time
 
 from dwd_forecast import DWD
+from dwd_transform import DwdForecastTransform, local_extrema
+
+
+def _import_pyplot():
+    # matplotlib is imported on first plot, it is not needed for the data-only code paths.
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return None
+    return plt
 
 
 class DwdForecastPlot:
-    def __init__(self):
-        self.dwd = DWD()
+    def __init__(self, dwd=None):
+        self.log = logging.getLogger("DwdForecastPlot")
+        if dwd is None:
+            dwd = DWD()
+        self.dwd = dwd
+        self.transform = DwdForecastTransform(self.dwd)
 
     def _datetime_from_utc_to_local(self, utc_datetime):
         now_timestamp = time.time()
@@ -38,38 +46,9 @@ class DwdForecastPlot:
         return localtime
 
     def get_local_minmaxs(self, x, y, mindist=2):
-        mins = []
-        maxs = []
-        # lastx=x[0]
-        lasty = y[0]
-        dist = 0
-        lastdirection = None
-        direction = 0
-        for xi, yi in zip(x, y):
-            if yi > lasty:
-                direction = 1
-            elif yi < lasty:
-                direction = -1
-            else:
-                direction = 0
-            if lastdirection == None or dist < mindist:
-                lasty = yi
-                # lastx=xi
-                lastdirection = direction
-                dist += 1
-                continue
-            if lastdirection != direction:
-                if direction == 1:
-                    mins.append((xi, yi))
-                    dist = 0
-                if direction == -1:
-                    maxs.append((xi, yi))
-                    dist = 0
-            else:
-                dist += 1
-            lasty = yi
-            # lastx=xi
-            lastdirection = direction
+        mins, maxs = local_extrema(y, mindist=mindist)
+        mins = [(x[i], y[i]) for i in mins]
+        maxs = [(x[i], y[i]) for i in maxs]
         return mins, maxs
 
     def format_date(self, x, pos=None):
@@ -86,8 +65,12 @@ class DwdForecastPlot:
         )  # arrowprops=arrowprops, bbox=bbox_props,
         ax.annotate(text, xy=(x, y), xytext=offset, annotation_clip=False, **kw)
 
-    def annot_local_minmax(self, x, y, ax=None):
-        mins, maxs = self.get_local_minmaxs(x, y, mindist=5)
+    def annot_local_minmax(self, x, y, ax=None, extrema=None):
+        if extrema is None:
+            mins, maxs = self.get_local_minmaxs(x, y, mindist=5)
+        else:
+            mins = [(x[i], y[i]) for i in extrema[0]]
+            maxs = [(x[i], y[i]) for i in extrema[1]]
         for mini, maxi in zip(mins, maxs):
             xmax = maxi[0]  # x[np.argmax(y)]
             ymax = maxi[1]  # y.max()
@@ -101,47 +84,37 @@ class DwdForecastPlot:
             text = "{:.1f}°C\n{}".format(ymin, dt)
             self.annotate(ax, xmin, ymin, text, (7, -15))
 
-    def plot(
-        self,
-        station_id,
-        image_file="weather.png",
-        force_cache_refresh=False,
-        close_plot=True,
-        dpi=96,
-    ):
-        self.dx = self.dwd.station_forecast(
-            station_id, force_cache_refresh=force_cache_refresh
-        )
-        if self.dx is None:
-            return None
-
-        # Temperature Kelvin -> Celsius
-        self.dxl = self.dx
-        self.dxl["TTT"] = self.dxl["TTT"].apply(lambda x: x - 273.15)
-        x = self.dxl["TTT"].index.to_numpy()
+    def _draw_forecast(self, ax1, forecast, title=None, label=None):
+        """Draw a derived forecast (see DwdForecastTransform) into ax1 and its twin axes."""
+        dxl = forecast["frame"]
+        x = dxl["TTT"].index.to_numpy()
         xl = [self._datetime_from_utc_to_local(xi) for xi in x]
-        y = self.dxl["TTT"].to_numpy()
-        y_sun = self.dxl["SunD1"].to_numpy() / 3600
-        y_rain = self.dxl["wwP"].to_numpy() / 100.0
-        y_rain_dur = self.dxl["DRR1"].to_numpy() / 3600.0
-
-        my_dpi = dpi
-        plt.figure(figsize=(800 / my_dpi, 480 / my_dpi), dpi=my_dpi)
-        fig, ax1 = plt.subplots()
-        fig.set_size_inches(800 / my_dpi, 480 / my_dpi)
+        y = dxl["TTT"].to_numpy()
+        y_sun = dxl["SunD1"].to_numpy()
+        y_rain = dxl["wwP"].to_numpy()
+        y_rain_dur = dxl["DRR1"].to_numpy()
 
         ax1.set_zorder(10)
         ax1.patch.set_visible(False)
-        title = "DWD OpenData - " + time.strftime("%A, %d.%m.%y %H:%M")
-        ax1.text(
-            1,
-            1.01,
-            title,
-            horizontalalignment="right",
-            color="gray",
-            verticalalignment="bottom",
-            transform=ax1.transAxes,
-        )
+        if title is not None:
+            ax1.text(
+                1,
+                1.01,
+                title,
+                horizontalalignment="right",
+                color="gray",
+                verticalalignment="bottom",
+                transform=ax1.transAxes,
+            )
+        if label is not None:
+            ax1.text(
+                0,
+                1.01,
+                label,
+                horizontalalignment="left",
+                verticalalignment="bottom",
+                transform=ax1.transAxes,
+            )
 
         ax3 = ax1.twinx()
         ax3.set_zorder(1)
@@ -163,7 +136,7 @@ class DwdForecastPlot:
         ax1.grid(True, linestyle="dotted")
         # ax1.set_axisbelow(False)
 
-        self.annot_local_minmax(xl, y, ax1)
+        self.annot_local_minmax(xl, y, ax1, extrema=(forecast["mins"], forecast["maxs"]))
 
         ax1.axvline(datetime.datetime.now(), color="dimgray", alpha=0.6)
 
@@ -172,25 +145,138 @@ class DwdForecastPlot:
         lim2 = (lim[0] - d / 10, lim[1] + d / 10)
         ax1.set_ylim(lim2)
 
+    def _format_date_axis(self, plt, fig, axes):
+        """Weekday locator and formatter, set once for x axes shared by all of axes."""
+        from matplotlib.dates import MO, TU, WE, TH, FR, SA, SU
+        from matplotlib.dates import WeekdayLocator
+        from matplotlib.dates import DateFormatter
+
         loc = WeekdayLocator(byweekday=(MO, TU, WE, TH, FR, SA, SU))  # , tz=tz)
-        ax1.xaxis.set_major_locator(loc)
+        axes[0].xaxis.set_major_locator(loc)
 
         better_formatter = DateFormatter("%a  \n%d.%m.")
-        ax1.xaxis.set_major_formatter(better_formatter)
+        axes[0].xaxis.set_major_formatter(better_formatter)
         fig.autofmt_xdate()
-        plt.setp(ax1.xaxis.get_majorticklabels(), rotation=0)
-
-        for tick in ax1.xaxis.get_major_ticks():
-            tick.label1.set_horizontalalignment("left")
+        for ax1 in axes:
+            plt.setp(ax1.xaxis.get_majorticklabels(), rotation=0)
+            for tick in ax1.xaxis.get_major_ticks():
+                tick.label1.set_horizontalalignment("left")
         # ax1.xaxis.set_major_locator(MaxNLocator(prune='both'))
 
+    def _station_label(self, station_id):
+        # Station names are only used if the station list is already loaded
+        df = self.dwd.station_list_df
+        if df is not None:
+            names = df["Stationsname"][df["Stations-kennung"].astype(str) == str(station_id)]
+            if len(names) > 0:
+                return f"{names.iloc[0]} ({station_id})"
+        return str(station_id)
+
+    def plot(
+        self,
+        station_id,
+        image_file="weather.png",
+        force_cache_refresh=False,
+        close_plot=True,
+        dpi=96,
+    ):
+        plt = _import_pyplot()
+        if plt is None:
+            self.log.error("plot() requires matplotlib module.")
+            return False
+
+        forecast = self.transform.station_forecast(
+            station_id, force_cache_refresh=force_cache_refresh
+        )
+        if forecast is None:
+            return None
+
+        # Display units (°C, hours, probability 0..1), the raw DWD frame is not modified
+        self.dx = forecast["raw"]
+        self.dxl = forecast["frame"]
+
+        my_dpi = dpi
+        fig, ax1 = plt.subplots()
+        fig.set_size_inches(800 / my_dpi, 480 / my_dpi)
+
+        title = "DWD OpenData - " + time.strftime("%A, %d.%m.%y %H:%M")
+        self._draw_forecast(ax1, forecast, title=title)
+        self._format_date_axis(plt, fig, [ax1])
+
         if image_file is not None:
-            plt.savefig(image_file, dpi=my_dpi, bbox_inches="tight")
+            fig.savefig(image_file, dpi=my_dpi, bbox_inches="tight")
         if close_plot is True:
             plt.close(
                 "all"
             )  # otherwise auto-refresh of web-server creates infinite number of figures...
 
+    def plot_composite(
+        self,
+        station_ids,
+        image_file="weather-composite.png",
+        layout="grid",
+        cols=None,
+        force_cache_refresh=False,
+        close_plot=True,
+        dpi=96,
+        panel_size=(800, 480),
+    ):
+        """Plot several stations into one figure.
+
+        `layout="grid"`: panels in a grid with `cols` columns (default: square-ish),
+        `layout="stack"`: aligned small multiples in one column.
+        All panels share the x axis (same forecast run), forecasts are loaded as batch.
+        Returns True on success, False if matplotlib is not available, None if no forecast is available.
+        """
+        plt = _import_pyplot()
+        if plt is None:
+            self.log.error("plot_composite() requires matplotlib module.")
+            return False
+
+        forecasts = self.transform.station_forecasts(
+            station_ids, force_cache_refresh=force_cache_refresh
+        )
+        panels = [(id, fc) for id, fc in zip(station_ids, forecasts) if fc is not None]
+        for id, fc in zip(station_ids, forecasts):
+            if fc is None:
+                self.log.warning(f"No forecast for station {id}, skipped")
+        if len(panels) == 0:
+            return None
+
+        n = len(panels)
+        if layout == "stack":
+            cols = 1
+        elif cols is None:
+            cols = int(np.ceil(np.sqrt(n)))
+        cols = max(1, min(cols, n))
+        rows = int(np.ceil(n / cols))
+
+        my_dpi = dpi
+        fig, axes = plt.subplots(rows, cols, sharex=True, squeeze=False)
+        fig.set_size_inches(cols * panel_size[0] / my_dpi, rows * panel_size[1] / my_dpi)
+        axes = axes.flatten()
+        for ax1 in axes[n:]:
+            fig.delaxes(ax1)
+
+        title = "DWD OpenData - " + time.strftime("%A, %d.%m.%y %H:%M")
+        for i, (id, fc) in enumerate(panels):
+            self._draw_forecast(
+                axes[i],
+                fc,
+                title=title if i == cols - 1 else None,
+                label=self._station_label(id),
+            )
+        self._format_date_axis(plt, fig, list(axes[:n]))
+        for i in range(n):
+            if i + cols >= n:  # lowest panel of its column, the panel below was removed
+                axes[i].xaxis.set_tick_params(labelbottom=True)
+
+        if image_file is not None:
+            fig.savefig(image_file, dpi=my_dpi, bbox_inches="tight")
+        if close_plot is True:
+            plt.close("all")
+        return True
+
 
 if __name__ == "__main__":
     logging.basicConfig(
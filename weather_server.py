@@ -7,14 +7,28 @@ import mimetypes
 import socket
 import os
 import struct
+import re
+import gzip
+import zlib
 import numpy as np
 
-from flask import Flask, send_from_directory
-from gevent import pywsgi
-from PIL import Image
+from flask import Flask, send_from_directory, request, Response
+
+try:
+    import brotli
+
+    brotli_loaded = True
+except ImportError:
+    brotli_loaded = False
+
+API_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,32}$")  # station ids and element names
+COMPOSITE_MAX_STATIONS = 16  # panels per composite image
+API_MAX_STATIONS = 16  # stations per /api/forecast request, missing ones are downloaded
 
 import weather_plot
 
+# gevent and PIL are imported on first use, PIL is only needed for /ministation.
+
 
 class WeatherServer:
     def __init__(
@@ -25,6 +39,7 @@ class WeatherServer:
         default_station_id=None,
         dpi=96,
         threading=True,
+        snapshot=True,
     ):
         mimetypes.add_type("text/css", ".css")
         mimetypes.add_type("text/javascript", ".js")
@@ -61,15 +76,23 @@ class WeatherServer:
             "/ministation/<path:path>", "ministations", self.ministations
         )
         self.app.add_url_rule("/auto/<path:path>", "autostations", self.autostations)
+        self.app.add_url_rule("/composite/<path:path>", "composite", self.composite)
         self.app.add_url_rule("/scripts/weather.js", "script", self.weather_script)
         self.app.add_url_rule("/styles/weather.css", "style", self.weather_style)
         self.app.add_url_rule("/favicon.ico", "favi", self.favicon)
         self.app.add_url_rule("/weather.png", "weather", self.weather_plot)
         self.app.add_url_rule("/weather.bin", "miniweather", self.miniweather_plot)
+        self.app.add_url_rule("/api/forecast", "api_forecast", self.api_forecast)
+        self.app.add_url_rule(
+            "/api/forecast/<path:path>", "api_forecast_station", self.api_forecast_station
+        )
         self.active = True
+        self.wplot = weather_plot.DwdForecastPlot()
+        if snapshot is True:
+            self.wplot.dwd.snapshot_autosave = True
+            self.snapshot_loader()  # Restore last state in background
         if threading is True:
             self.socket_handler()  # Start threads for web
-        self.wplot = weather_plot.DwdForecastPlot()
 
     def web_root(self):
         return self.app.send_static_file("index.html")
@@ -86,12 +109,14 @@ class WeatherServer:
 
     def weather_plot(self):
         imagefile = os.path.join(self.static_resources, "/weather.png")
-        self.wplot.plot(self.station_id, image_file=imagefile)
+        if self.wplot.plot(self.station_id, image_file=imagefile) is False:
+            return "Plotting not available", 503
         return self.app.send_static_file("weather.png")
 
     def miniweather_plot(self):
         imagefile = os.path.join(self.static_resources, "/weather.bin")
-        self.wplot.plot(self.station_id, image_file=imagefile)
+        if self.wplot.plot(self.station_id, image_file=imagefile) is False:
+            return "Plotting not available", 503
         return self.app.send_static_file("weather.bmp")
 
     def autostations(self, path):
@@ -101,9 +126,33 @@ class WeatherServer:
         id = path.split("/")[-1]
         self.log.info(f"We are getting {id}")
         imagefile = os.path.join(self.static_resources, "weather.png")
-        self.wplot.plot(id, image_file=imagefile, dpi=self.dpi)
+        if self.wplot.plot(id, image_file=imagefile, dpi=self.dpi) is False:
+            return "Plotting not available", 503
         return self.app.send_static_file("weather.png")
 
+    def composite(self, path):
+        ids = [id for id in path.split("/")[-1].split(",") if id != ""]
+        if len(ids) == 0 or len(ids) > COMPOSITE_MAX_STATIONS:
+            return f"Between 1 and {COMPOSITE_MAX_STATIONS} station ids required", 400
+        for id in ids:
+            if API_NAME_PATTERN.match(id) is None:
+                return f"Invalid station id {id[:32]}", 400
+        layout = request.args.get("layout", "grid")
+        if layout not in ("grid", "stack"):
+            return f"Unknown layout {layout}", 400
+        cols = request.args.get("cols")
+        cols = int(cols) if cols is not None and cols.isdigit() else None
+        self.log.info(f"We are getting {ids} as {layout}")
+        imagefile = os.path.join(self.static_resources, "weather-composite.png")
+        result = self.wplot.plot_composite(
+            ids, image_file=imagefile, layout=layout, cols=cols, dpi=self.dpi
+        )
+        if result is False:
+            return "Plotting not available", 503
+        if result is None:
+            return "No forecast available", 404
+        return self.app.send_static_file("weather-composite.png")
+
     def img2rgb565(self, image, output_file):
         image_rgb = image.convert("RGB")
         # Convert the image to a numpy array
@@ -140,8 +189,14 @@ class WeatherServer:
     def ministations(self, path):
         id = path.split("/")[-1]
         self.log.info(f"We are getting {id}")
+        try:
+            from PIL import Image
+        except ImportError:
+            self.log.error("ministation requires PIL (pillow) module.")
+            return "Image conversion not available", 503
         imagefile = os.path.join(self.static_resources, "weather.png")
-        self.wplot.plot(id, image_file=imagefile, dpi=self.dpi)
+        if self.wplot.plot(id, image_file=imagefile, dpi=self.dpi) is False:
+            return "Plotting not available", 503
         # resize imagefile to 240x135 and save as weather.bmp
         image = Image.open(imagefile).convert("RGB")
         image_rgb = image.resize((240, 135))
@@ -149,7 +204,259 @@ class WeatherServer:
         self.img2rgb565(image_rgb, binimagefile)
         return self.app.send_static_file("weather.bin")
 
+    def _api_params(self):
+        """Parse projection and format parameters of an /api/forecast request.
+
+        `elements`: comma separated DWD element names (default: all),
+        `start`, `end`: ISO time (UTC) or epoch seconds, `hours`: window from now,
+        `units`: `display` (see dwd_transform.convert_units, default) or `raw` (DWD units),
+        `format`: `json` (default), `ndjson` or `bin`, `dtype`: `f32` (default) or `f16` for `bin`.
+        """
+        args = request.args
+        params = {}
+        elements = args.get("elements")
+        if elements is not None and elements != "":
+            params["elements"] = self._api_names(elements, "element")
+        else:
+            params["elements"] = None
+        params["start"] = self._parse_api_time(args.get("start"))
+        params["end"] = self._parse_api_time(args.get("end"))
+        hours = args.get("hours")
+        if hours is not None:
+            now = np.datetime64(int(time.time()), "s")
+            if params["start"] is None:
+                params["start"] = now
+            params["end"] = now + np.timedelta64(int(hours), "h")
+        params["units"] = args.get("units", "display")
+        if params["units"] not in ("display", "raw"):
+            raise ValueError(f"unknown units {params['units']}")
+        params["format"] = args.get("format", "json")
+        if params["format"] not in ("json", "ndjson", "bin"):
+            raise ValueError(f"unknown format {params['format']}")
+        dtype = args.get("dtype", "f32")
+        if dtype not in ("f16", "f32"):
+            raise ValueError(f"unknown dtype {dtype}")
+        params["dtype"] = np.float16 if dtype == "f16" else np.float32
+        if params["units"] == "raw" and dtype == "f16":
+            # PPPP in Pa (~101325) overflows float16
+            raise ValueError("dtype f16 requires units display")
+        return params
+
+    def _api_names(self, value, kind):
+        names = [n for n in value.split(",") if n != ""]
+        for name in names:
+            if API_NAME_PATTERN.match(name) is None:
+                raise ValueError(f"invalid {kind} {name!r}")
+        return names
+
+    def _parse_api_time(self, value):
+        if value is None or value == "":
+            return None
+        if value.isdigit():
+            return np.datetime64(int(value), "s")
+        return np.datetime64(value)
+
+    def _api_encoding(self):
+        accept = request.headers.get("Accept-Encoding", "")
+        if brotli_loaded is True and "br" in accept:
+            return "br"
+        if "gzip" in accept:
+            return "gzip"
+        return None
+
+    def _project(self, forecast, params):
+        """Project a derived forecast (see DwdForecastTransform) to elements and time window.
+
+        Returns (run, times (epoch seconds), element names, values [element, time]) or None.
+        """
+        if forecast is None:
+            return None
+        if params["units"] == "raw":
+            frame = forecast["raw"]
+        else:
+            frame = forecast["frame"]
+        times = frame.index.to_numpy()
+        mask = np.ones(len(times), dtype=bool)
+        if params["start"] is not None:
+            mask &= times >= params["start"]
+        if params["end"] is not None:
+            mask &= times <= params["end"]
+        names = params["elements"]
+        if names is None:
+            names = list(frame.columns)
+        values = np.full((len(names), int(mask.sum())), np.nan)
+        for i, name in enumerate(names):
+            if name in frame.columns:
+                values[i] = frame[name].to_numpy()[mask]
+        epochs = times[mask].astype("datetime64[s]").astype(np.int64)
+        return forecast["run"], epochs, names, values
+
+    def _api_record(self, station_id, forecast, params):
+        projection = self._project(forecast, params)
+        if projection is None:
+            return {"station": str(station_id), "error": "no forecast available"}
+        run, epochs, names, values = projection
+        elements = {}
+        for name, row in zip(names, values):
+            elements[name] = [None if np.isnan(v) else v for v in row.tolist()]
+        return {
+            "station": str(station_id),
+            "run": run,
+            "times": epochs.tolist(),
+            "elements": elements,
+        }
+
+    def _api_binary_record(self, station_id, forecast, params, missing=False):
+        """Packed little-endian record for microcontrollers.
+
+        Header `<4sBBHHI`: magic `DWDF`, version 1, bytes per value (2: float16, 4: float32),
+        n_elements, n_times, forecast run (epoch seconds, 0: no forecast available).
+        Followed by the station id, n_times uint32 times (epoch seconds UTC), n_elements
+        element names, and n_elements * n_times values (element major, NaN: missing).
+        Station id and element names are ascii strings prefixed by a uint8 length.
+        If no forecast is available, None is returned, or a record with n_times = 0 if `missing` is True.
+        Raises ValueError if values exceed the range of the dtype (e.g. VV in m as float16).
+        """
+        projection = self._project(forecast, params)
+        if projection is None:
+            if missing is False:
+                return None
+            names = params["elements"] or []
+            projection = (0, np.zeros(0, dtype=np.int64), names, np.zeros((len(names), 0)))
+        run, epochs, names, values = projection
+        dtype = np.dtype(params["dtype"]).newbyteorder("<")
+        header = struct.pack(
+            "<4sBBHHI",
+            b"DWDF",
+            1,
+            dtype.itemsize,
+            len(names),
+            len(epochs),
+            int(run or 0),
+        )
+        with np.errstate(over="ignore"):
+            packed = values.astype(dtype)
+        overflow = np.isfinite(values) & ~np.isfinite(packed)
+        if np.any(overflow):
+            rows = np.flatnonzero(overflow.any(axis=1))
+            raise ValueError(
+                f"elements {[names[i] for i in rows]} exceed the range of dtype {dtype.name}"
+            )
+        strings = [str(station_id)] + list(names)
+        string_block = [struct.pack("B", len(n)) + n.encode("ascii") for n in strings]
+        return (
+            header
+            + string_block[0]
+            + epochs.astype("<u4").tobytes()
+            + b"".join(string_block[1:])
+            + packed.tobytes()
+        )
+
+    def _compress_stream(self, chunks, encoding):
+        if encoding == "gzip":
+            compressor = zlib.compressobj(wbits=31)  # gzip container
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if len(data) > 0:
+                    yield data
+            yield compressor.flush()
+        elif encoding == "br":
+            compressor = brotli.Compressor()
+            for chunk in chunks:
+                data = compressor.process(chunk)
+                if len(data) > 0:
+                    yield data
+            yield compressor.finish()
+        else:
+            for chunk in chunks:
+                yield chunk
+
+    def _api_response(self, station_ids, params, single=False):
+        # forecasts that are not held by the server are downloaded as one parallel batch
+        forecasts = self.wplot.transform.station_forecasts(station_ids)
+        encoding = self._api_encoding()
+        headers = {"Vary": "Accept-Encoding"}
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        fmt = params["format"]
+        if fmt == "ndjson":
+            lines = (
+                (json.dumps(self._api_record(id, fc, params)) + "\n").encode("utf-8")
+                for id, fc in zip(station_ids, forecasts)
+            )
+            return Response(
+                self._compress_stream(lines, encoding),
+                mimetype="application/x-ndjson",
+                headers=headers,
+            )
+        if fmt == "bin":
+            # records are packed before the response starts, a range error is still a 400
+            try:
+                records = [
+                    self._api_binary_record(id, fc, params, missing=not single)
+                    for id, fc in zip(station_ids, forecasts)
+                ]
+            except ValueError as e:
+                return Response(json.dumps({"error": str(e)}), 400, mimetype="application/json")
+            if records[0] is None:
+                return Response(
+                    json.dumps({"station": station_ids[0], "error": "no forecast available"}),
+                    404,
+                    mimetype="application/json",
+                )
+            return Response(
+                self._compress_stream(records, encoding),
+                mimetype="application/octet-stream",
+                headers=headers,
+            )
+        if single is True:
+            record = self._api_record(station_ids[0], forecasts[0], params)
+            status = 404 if "error" in record else 200
+        else:
+            record = {
+                "stations": [
+                    self._api_record(id, fc, params) for id, fc in zip(station_ids, forecasts)
+                ]
+            }
+            status = 200
+        body = json.dumps(record).encode("utf-8")
+        if encoding == "gzip":
+            body = gzip.compress(body)
+        elif encoding == "br":
+            body = brotli.compress(body)
+        return Response(
+            body, status=status, mimetype="application/json", headers=headers
+        )
+
+    def api_forecast_station(self, path):
+        id = path.split("/")[-1]
+        try:
+            self._api_names(id, "station id")
+            params = self._api_params()
+        except (ValueError, OverflowError) as e:
+            return Response(json.dumps({"error": str(e)}), 400, mimetype="application/json")
+        return self._api_response([id], params, single=True)
+
+    def api_forecast(self):
+        try:
+            ids = self._api_names(request.args.get("ids", ""), "station id")
+        except ValueError as e:
+            return Response(json.dumps({"error": str(e)}), 400, mimetype="application/json")
+        if len(ids) == 0 or len(ids) > API_MAX_STATIONS:
+            return Response(
+                json.dumps({"error": f"parameter ids requires 1 to {API_MAX_STATIONS} station ids"}),
+                400,
+                mimetype="application/json",
+            )
+        try:
+            params = self._api_params()
+        except (ValueError, OverflowError) as e:
+            return Response(json.dumps({"error": str(e)}), 400, mimetype="application/json")
+        return self._api_response(ids, params)
+
     def socket_event_worker_thread(self, log, app, keyfile=None, certfile=None):
+        from gevent import pywsgi
+
         if self.certfile is None or self.keyfile is None:
             server = pywsgi.WSGIServer(("0.0.0.0", self.port), app)
             self.log.info(f"Web browser: http://{socket.gethostname()}:{self.port}")
@@ -172,6 +479,9 @@ class WeatherServer:
         self.socket_event_thread.daemon = True
         self.socket_event_thread.start()
 
+    def snapshot_loader(self):
+        self.snapshot_thread = self.wplot.dwd.load_snapshot(background=True)
+
 
 if __name__ == "__main__":
     import argparse
@@ -204,6 +514,12 @@ if __name__ == "__main__":
         "--keyfile",
         help="optional key file. If both certfile and keyfile are given, https is use.",
     )
+    parser.add_argument(
+        "--no-snapshot",
+        default=False,
+        action="store_true",
+        help="don't restore or save the startup snapshot of station list and forecasts",
+    )
     args = parser.parse_args()
 
     ws = WeatherServer(
@@ -212,6 +528,7 @@ if __name__ == "__main__":
         certfile=args.certfile,
         threading=args.threading,
         dpi=args.dpi,
+        snapshot=not args.no_snapshot,
     )
     if args.threading is True:
         while True: